@@ -0,0 +1,506 @@
+#! /usr/bin/python
+
+'''
+ Copyright 2019-present SK Telecom
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+'''
+
+import os
+import sys
+import time
+import json
+import math
+import uuid
+import hashlib
+import glob
+import shlex
+import socket
+import argparse
+import tempfile
+import threading
+import collections
+import subprocess
+import ipaddress
+import BaseHTTPServer
+import SocketServer
+
+DEFAULT_CNI_BINARY = "/opt/cni/bin/sona"
+DEFAULT_POD_CIDR = "10.244.1.0/24"
+ONOS_PORT_NUM = 8181
+ONOS_K8S_NODE_PATH = "/onos/k8snode/"
+ONOS_K8S_NETWORKING_PATH = "/onos/k8snetworking/"
+K8S_NODES_PATH = "/api/v1/nodes"
+REPLAY_NETNS_PREFIX = "replay-"
+REPLAY_COMMANDS = [ "ADD", "DEL" ]
+PERCENTILES = [ 50, 90, 99 ]
+
+KUBECONFIG_TEMPLATE = """apiVersion: v1
+kind: Config
+clusters:
+- cluster:
+    server: http://127.0.0.1:%d
+  name: replay
+contexts:
+- context:
+    cluster: replay
+    user: replay
+  name: replay
+current-context: replay
+users:
+- name: replay
+  user: {}
+"""
+
+def call_popen(cmd):
+    '''
+    Executes a shell command.
+
+    :param    cmd: shell command to be executed
+    :return    standard output of the executed result
+    '''
+    child = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    output = child.communicate()
+    if child.returncode:
+        raise RuntimeError("Fatal error executing %s" % (cmd))
+    if len(output) == 0 or output[0] is None:
+        output = ""
+    else:
+        output = output[0].decode("utf8").strip()
+    return output
+
+def load_journal(path):
+    '''
+    Loads CNI invocation records from a journal and its rotated files.
+
+    :param    path:    journal path
+    :return    CNI invocation records ordered by arrival time
+    '''
+    records = []
+    for journal_file in glob.glob(path) + glob.glob(path + ".[0-9]*"):
+        with open(journal_file) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    records.append(json.loads(line))
+    return sorted(records, key=lambda record: record['ts'])
+
+def write_journal(path, records):
+    '''
+    Writes CNI invocation records as a journal.
+
+    :param    path:       journal path
+              records:    CNI invocation records
+    '''
+    with open(path, "w") as f:
+        for record in records:
+            f.write(json.dumps(record, separators=(',', ':')) + "\n")
+
+def get_container_id(cni_args):
+    '''
+    Obtains the container identifier from the CNI arguments.
+
+    :param    cni_args:    CNI arguments (e.g., K8S_POD_NAME=a;K8S_POD_...)
+    :return    container identifier
+    '''
+    cni_args_dict = dict(i.split("=") for i in cni_args.split(";"))
+    return cni_args_dict['K8S_POD_INFRA_CONTAINER_ID']
+
+def replay_cni_args(cni_args, nonce):
+    '''
+    Rewrites the container identifier of the CNI arguments to a replay
+    unique one, so that the replay never touches the veth and netns of
+    pods which are still running.
+
+    :param    cni_args:    CNI arguments
+              nonce:       replay run nonce
+    :return    CNI arguments with a replay unique container identifier
+    '''
+    replaced = []
+    for arg in cni_args.split(";"):
+        key, value = arg.split("=", 1)
+        if key == 'K8S_POD_INFRA_CONTAINER_ID':
+            value = hashlib.sha256(nonce + value).hexdigest()
+        replaced.append(key + "=" + value)
+    return ";".join(replaced)
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    Answers the ONOS and Kubernetes REST calls issued by the SONA CNI.
+    '''
+
+    def log_message(self, format, *args):
+        return
+
+    def reply(self, code, data=None):
+        time.sleep(self.server.delay)
+        body = json.dumps(data if data is not None else {})
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def node(self):
+        return {'apiVersion': 'v1', 'kind': 'Node',
+                'metadata': {'name': self.server.node_name,
+                             'labels': {'node-role.kubernetes.io/master': ''}},
+                'spec': {'podCIDR': self.server.pod_cidr},
+                'status': {'addresses': [{'type': 'InternalIP',
+                                          'address': '127.0.0.1'}]}}
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == K8S_NODES_PATH:
+            self.reply(200, {'apiVersion': 'v1', 'kind': 'NodeList',
+                             'metadata': {}, 'items': [self.node()]})
+        elif path.startswith(K8S_NODES_PATH + "/"):
+            self.reply(200, self.node())
+        elif path.startswith(ONOS_K8S_NODE_PATH + "configure/state/"):
+            self.reply(200, {'State': 'COMPLETE'})
+        elif path.startswith(ONOS_K8S_NETWORKING_PATH + "network/exist/"):
+            self.reply(200, {'result': True})
+        elif path.startswith(ONOS_K8S_NETWORKING_PATH + "ipam/"):
+            ip = self.server.allocate_ip()
+            if ip is None:
+                self.reply(503, {'error': 'IP address pool is exhausted'})
+            else:
+                self.reply(200, {'ipam': {'ipAddress': ip}})
+        else:
+            self.reply(404)
+
+    def do_PUT(self):
+        self.reply(200)
+
+    def do_POST(self):
+        self.reply(201)
+
+    def do_DELETE(self):
+        # ipam/<network id>/<ip address>
+        path = self.path.split('?')[0]
+        if path.startswith(ONOS_K8S_NETWORKING_PATH + "ipam/"):
+            self.server.release_ip(path.rstrip('/').rsplit('/', 1)[1])
+        self.reply(204)
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''
+    Local stand-in of ONOS and the Kubernetes API server.
+    '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port, node_name, pod_cidr, delay):
+        '''
+        The stand-in constructor.
+
+        :param  port:       listening port
+                node_name:  kubernetes node name
+                pod_cidr:   pod CIDR of the kubernetes node
+                delay:      delay in seconds added to every response
+        '''
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port),
+                                           StandInHandler)
+        self.node_name = node_name
+        self.pod_cidr = pod_cidr
+        self.delay = delay
+        self._lock = threading.Lock()
+        hosts = ipaddress.ip_network(pod_cidr.decode('unicode_escape')).hosts()
+        # the first host address is used by the gateway
+        self._free = collections.deque(str(host) for host in hosts)
+        self._free.popleft()
+        self._allocated = set()
+
+    def allocate_ip(self):
+        '''
+        Allocates a free IP address of the pod CIDR.
+
+        :return    allocated IP address, or None if the pool is exhausted
+        '''
+        with self._lock:
+            if not self._free:
+                return None
+            ip = self._free.popleft()
+            self._allocated.add(ip)
+            return ip
+
+    def release_ip(self, ip):
+        '''
+        Returns an allocated IP address to the pool.
+
+        :param    ip:    IP address to be released
+        '''
+        with self._lock:
+            if ip in self._allocated:
+                self._allocated.remove(ip)
+                self._free.append(ip)
+
+def invoke(binary, record, create_netns, env, nonce):
+    '''
+    Re-drives a single recorded CNI invocation.
+
+    :param  binary:         CNI binary path
+            record:         CNI invocation record
+            create_netns:   whether to use a fresh network namespace
+            env:            base environment of the CNI binary
+            nonce:          replay run nonce
+    :return    CNI invocation result
+    '''
+    cni_args = replay_cni_args(record['args'], nonce)
+    netns = record['netns']
+    netns_name = REPLAY_NETNS_PREFIX + get_container_id(cni_args)[:12]
+    is_add = record['command'] == "ADD"
+    if create_netns:
+        netns = "/var/run/netns/" + netns_name
+        if is_add:
+            call_popen(shlex.split("ip netns add %s" % netns_name))
+
+    # the CNI binary journals into its own file, away from the host journal
+    journal_fd, journal_path = tempfile.mkstemp(suffix=".journal")
+    os.close(journal_fd)
+
+    env = dict(env)
+    env['CNI_COMMAND'] = record['command']
+    env['CNI_ARGS'] = cni_args
+    env['CNI_IFNAME'] = record['ifname']
+    env['CNI_NETNS'] = netns
+    env['SONA_JOURNAL_PATH'] = journal_path
+
+    succeeded = False
+    try:
+        started = time.time()
+        child = subprocess.Popen([binary], env=env, stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT)
+        output = child.communicate()[0]
+        wall_duration = time.time() - started
+        succeeded = child.returncode == 0
+
+        journal = load_journal(journal_path)
+    finally:
+        for path in glob.glob(journal_path + "*"):
+            os.remove(path)
+
+        # a failed ADD leaves no pod behind, so its namespace goes as well
+        if create_netns and (not is_add or not succeeded):
+            with open(os.devnull, "w") as devnull:
+                subprocess.call(["ip", "netns", "del", netns_name],
+                                stdout=devnull, stderr=devnull)
+
+    if journal:
+        # keep the in-process duration so that it compares with the capture
+        result = journal[0]
+    else:
+        result = {'ts': started, 'command': record['command'],
+                  'args': cni_args, 'ifname': record['ifname'],
+                  'netns': netns, 'duration': None, 'outcome': "error",
+                  'error': "no journal record written by " + binary}
+
+    result['wall_duration'] = round(wall_duration, 6)
+    if child.returncode:
+        result['outcome'] = "error"
+        result['error'] = output.strip()
+    return result
+
+def replay(args):
+    '''
+    Re-drives a captured journal, keeping the recorded arrival pattern.
+    '''
+    # invocations recorded without CNI arguments cannot be re-driven
+    records = [record for record in load_journal(args.journal)
+               if record.get('command') in REPLAY_COMMANDS and
+               record.get('args')]
+    if not records:
+        raise RuntimeError("no ADD/DEL invocations found in " + args.journal)
+
+    env = dict(os.environ)
+    server = None
+    if not args.live:
+        try:
+            server = StandInServer(ONOS_PORT_NUM, socket.gethostname(),
+                                   args.pod_cidr, args.delay)
+        except socket.error as e:
+            # never fall through to a real ONOS listening on the same port
+            raise RuntimeError("failure bind stand-in port %d: %s" %
+                               (ONOS_PORT_NUM, str(e)))
+        stand_in = threading.Thread(target=server.serve_forever)
+        stand_in.daemon = True
+        stand_in.start()
+
+        kubeconfig = tempfile.NamedTemporaryFile(suffix=".kubeconfig",
+                                                 delete=False)
+        kubeconfig.write(KUBECONFIG_TEMPLATE % ONOS_PORT_NUM)
+        kubeconfig.close()
+        env['KUBECONFIG'] = kubeconfig.name
+
+    # container identifiers are rewritten per run, ADD and DEL of the same
+    # container still agree on the rewritten identifier
+    nonce = uuid.uuid4().hex
+
+    results = []
+    results_lock = threading.Lock()
+
+    def run(record):
+        try:
+            result = invoke(args.binary, record, args.create_netns, env,
+                            nonce)
+        except Exception as e:
+            result = {'ts': time.time(), 'command': record['command'],
+                      'args': record['args'], 'ifname': record.get('ifname'),
+                      'netns': record.get('netns'), 'duration': None,
+                      'outcome': "error", 'error': str(e)}
+        with results_lock:
+            results.append(result)
+
+    workers = []
+    origin = records[0]['ts']
+    started = time.time()
+    try:
+        for record in records:
+            delay = started + (record['ts'] - origin) / args.speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            worker = threading.Thread(target=run, args=(record,))
+            worker.start()
+            workers.append(worker)
+
+        for worker in workers:
+            worker.join()
+    finally:
+        if server is not None:
+            server.shutdown()
+            os.remove(env['KUBECONFIG'])
+
+    results.sort(key=lambda result: result['ts'])
+    write_journal(args.output, results)
+    print_summary(results)
+
+def percentile(values, pct):
+    '''
+    Obtains the nearest-rank percentile of the given values.
+
+    :param    values:  sorted values
+              pct:     percentile (0-100)
+    :return    percentile value
+    '''
+    index = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[min(max(index, 0), len(values) - 1)]
+
+def latency_summary(records):
+    '''
+    Summarizes the latency distribution of each CNI command.
+
+    :param    records:    CNI invocation records
+    :return    summary keyed by CNI command
+    '''
+    durations = {}
+    counts = {}
+    errors = {}
+    for record in records:
+        command = record.get('command')
+        if command not in REPLAY_COMMANDS:
+            continue
+        counts[command] = counts.get(command, 0) + 1
+        durations.setdefault(command, [])
+        # invocations which never ran have no duration
+        if record.get('duration') is not None:
+            durations[command].append(record['duration'])
+        if record.get('outcome') != "ok":
+            errors[command] = errors.get(command, 0) + 1
+
+    summary = {}
+    for command, values in durations.items():
+        values.sort()
+        summary[command] = {'count': counts[command],
+                            'errors': errors.get(command, 0),
+                            'max': values[-1] if values else 0.0}
+        for pct in PERCENTILES:
+            summary[command]['p%d' % pct] = \
+                percentile(values, pct) if values else 0.0
+    return summary
+
+def print_summary(records):
+    '''
+    Prints the latency distribution of each CNI command.
+    '''
+    summary = latency_summary(records)
+    columns = ['count', 'errors'] + ['p%d' % pct for pct in PERCENTILES] + ['max']
+    print("%-8s" % "command" + "".join("%10s" % c for c in columns))
+    for command in REPLAY_COMMANDS:
+        if command not in summary:
+            continue
+        row = summary[command]
+        print("%-8s" % command + "%10d%10d" % (row['count'], row['errors']) +
+              "".join("%10.4f" % row[c] for c in columns[2:]))
+
+def compare(args):
+    '''
+    Compares the latency distributions of two journals (e.g., two builds).
+    '''
+    base = latency_summary(load_journal(args.base))
+    target = latency_summary(load_journal(args.target))
+    columns = ['p%d' % pct for pct in PERCENTILES] + ['max']
+
+    print("%-8s%-8s" % ("command", "stat") +
+          "%12s%12s%10s" % ("base", "target", "change"))
+    for command in REPLAY_COMMANDS:
+        if command not in base or command not in target:
+            continue
+        for column in columns:
+            before = base[command][column]
+            after = target[command][column]
+            change = "n/a"
+            if before > 0:
+                change = "%+.1f%%" % ((after - before) / before * 100)
+            print("%-8s%-8s" % (command, column) +
+                  "%12.4f%12.4f%10s" % (before, after, change))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replays recorded SONA CNI invocations.")
+    subparsers = parser.add_subparsers()
+
+    replay_parser = subparsers.add_parser(
+        "replay", help="re-drive a captured journal against the CNI binary")
+    replay_parser.add_argument("journal", help="captured journal path")
+    replay_parser.add_argument("-o", "--output", required=True,
+                               help="journal path of the replay results")
+    replay_parser.add_argument("-b", "--binary", default=DEFAULT_CNI_BINARY,
+                               help="CNI binary to be replayed")
+    replay_parser.add_argument("-s", "--speed", type=float, default=1.0,
+                               help="replay speed factor (e.g., 10 for 10x)")
+    replay_parser.add_argument("--live", action="store_true",
+                               help="replay against the real ONOS/Kubernetes "
+                                    "instead of local stand-ins")
+    replay_parser.add_argument("--pod-cidr", default=DEFAULT_POD_CIDR,
+                               help="pod CIDR served by the stand-ins")
+    replay_parser.add_argument("--delay", type=float, default=0.0,
+                               help="stand-in response delay in seconds")
+    replay_parser.add_argument("--create-netns", action="store_true",
+                               help="use fresh network namespaces")
+    replay_parser.set_defaults(func=replay)
+
+    compare_parser = subparsers.add_parser(
+        "compare", help="compare latency distributions of two journals")
+    compare_parser.add_argument("base", help="baseline journal path")
+    compare_parser.add_argument("target", help="target journal path")
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    if getattr(args, 'speed', 1.0) <= 0:
+        parser.error("speed must be positive")
+    args.func(args)
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception as e:
+        error = {'code': 200, 'message': str(e)}
+        print(json.dumps(error))
+        sys.exit(1)
@@ -18,12 +18,16 @@ import shlex
 import sys
 import time
 import json
+import select
+import argparse
+import subprocess
 import pyroute2
 import ConfigParser
 import socket
 import struct
 import netifaces
 from netaddr import *
+from pyroute2.netlink.rtnl import RTMGRP_IPV4_IFADDR
 from kubernetes import client, config
 
 SONA_CONFIG_FILE = "/etc/sona/sona-cni.conf"
@@ -31,6 +35,59 @@ SONA_CONFIG_FILE_ENV = os.environ.get("SONA_CONFIG_FILE_PATH")
 EXTERNAL_GW_IP = "external.gateway.ip"
 EXTERNAL_INTF_NAME = "external.interface.name"
 EXTERNAL_BR_IP = "external.bridge.ip"
+INT_BRIDGE_DPID = "integration.bridge.dpid"
+POD_CIDR = "pod.cidr"
+
+INT_BRIDGE = "kbr-int"
+EXT_BRIDGE = "kbr-ex"
+
+SYNC_RETRY_INTERVAL = 5
+SYNC_REFRESH_INTERVAL = 300
+
+def call_popen(cmd):
+    '''
+    Executes a shell command.
+
+    :param    cmd: shell command to be executed
+    :return    standard output of the executed result
+    '''
+    child = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    output = child.communicate()
+    if child.returncode:
+        raise RuntimeError("Fatal error executing %s" % (cmd))
+    if len(output) == 0 or output[0] is None:
+        output = ""
+    else:
+        output = output[0].decode("utf8").strip()
+    return output
+
+def ovs_ofctl(*args):
+    '''
+    A helper method to execute ovs-ofctl.
+
+    :param    args:    arguments pointer
+    :return    executed result of ovs-ofctl
+    '''
+    cmd = ["ovs-ofctl", "--timeout=5", "-vconsole:off"] + list(args)
+    return call_popen(cmd)
+
+def get_dpid():
+    '''
+    Obtains the data plane identifier.
+
+    :return    data plane identifier
+    '''
+    try:
+        of_result = ovs_ofctl('show', INT_BRIDGE)
+
+        if "dpid:" in of_result:
+            first_line = of_result.splitlines()[0]
+            return "of:" + first_line.split("dpid:", 1)[1]
+        else:
+            return None
+
+    except Exception as e:
+        raise SonaException(105, "failure get DPID " + str(e))
 
 def get_external_interface():
     '''
@@ -60,7 +117,11 @@ def get_external_bridge_ip():
     :return	external IP address
     '''
     ext_interface = get_external_interface()
-    return netifaces.ifaddresses(ext_interface)[netifaces.AF_INET][0]['addr']
+    # once SONA CNI is activated, the address is moved to external bridge
+    for interface in [ext_interface, EXT_BRIDGE]:
+        if interface in netifaces.interfaces() and is_interface_up(interface):
+            return netifaces.ifaddresses(interface)[netifaces.AF_INET][0]['addr']
+    return None
 
 def get_external_gateway_ip():
     '''
@@ -90,37 +151,140 @@ def is_interface_up(interface):
     addr = netifaces.ifaddresses(interface)
     return netifaces.AF_INET in addr
 
-def addAnnotationToNode(api_instance, node_name, annot_key, annot_value):
+def get_annotations(node, with_dpid, with_pod_cidr):
     '''
-    Adds annotaion to the existing kubernetes node.
-    
-    :return	kubernetes node update result
+    Computes all SONA annotations of the kubernetes node.
+
+    :param    node:            kubernetes node
+              with_dpid:       whether to include the data plane identifier
+              with_pod_cidr:   whether to include the pod CIDR
+    :return    SONA annotations, annotations without value are omitted
+    '''
+    annotations = {EXTERNAL_GW_IP: get_external_gateway_ip(),
+                   EXTERNAL_INTF_NAME: get_external_interface(),
+                   EXTERNAL_BR_IP: get_external_bridge_ip()}
+
+    if with_dpid:
+        # kbr-int may not exist yet, which must not block other annotations
+        try:
+            annotations[INT_BRIDGE_DPID] = get_dpid()
+        except SonaException as e:
+            print(e.sona_error())
+
+    if with_pod_cidr:
+        annotations[POD_CIDR] = node.spec.pod_cidr
+
+    return dict((key, value) for key, value in annotations.items()
+                if value is not None)
+
+def sync_annotations(api_instance, node, annotations):
     '''
-    node = api_instance.read_node(name=node_name)
-    node.metadata.annotations[annot_key] = annot_value
-    return api_instance.patch_node(name=node_name, body=node)
+    Patches the kubernetes node with the annotations which differ from
+    the given node, using a single merge patch.
+
+    :param    api_instance:    kubernetes core API
+              node:            cached kubernetes node
+              annotations:     SONA annotations
+    :return    updated kubernetes node, or the given node if nothing changed
+    '''
+    current = node.metadata.annotations or {}
+    changed = dict((key, value) for key, value in annotations.items()
+                   if current.get(key) != value)
+
+    if not changed:
+        return node
+
+    body = {'metadata': {'annotations': changed}}
+    return api_instance.patch_node(name=node.metadata.name, body=body)
+
+def watch_address_events(ipr, interfaces, timeout):
+    '''
+    Blocks until an IPv4 address of the given interfaces is added or removed,
+    or until the timeout expires.
+
+    :param    ipr:           netlink socket bound to IPv4 address events
+              interfaces:    network interface names
+              timeout:       timeout in seconds
+    :return    True if an address event is received, False on timeout
+    '''
+    deadline = time.time() + timeout
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+
+        readable, _, _ = select.select([ipr], [], [], remaining)
+        if not readable:
+            return False
+
+        for msg in ipr.get():
+            if msg['event'] not in ('RTM_NEWADDR', 'RTM_DELADDR'):
+                continue
+            if msg.get_attr('IFA_LABEL') in interfaces:
+                return True
 
 def main():
+    parser = argparse.ArgumentParser(
+        description="Publishes SONA annotations to the kubernetes node.")
+    parser.add_argument("--sync", action="store_true",
+                        help="keep annotations in sync with address changes")
+    parser.add_argument("--dpid", action="store_true",
+                        help="publish the data plane identifier")
+    parser.add_argument("--pod-cidr", action="store_true",
+                        help="publish the pod CIDR")
+    args = parser.parse_args()
 
-    ex_gw_ip = get_external_gateway_ip()
-    ex_br_ip = get_external_bridge_ip()
-    ex_gw_intf = get_external_interface()
     hostname = socket.gethostname()
 
     # Configs can be set in Configuration class directly or using helper utility
     config.load_kube_config()
 
     v1 = client.CoreV1Api()
- 
-    if hostname is not None:
-        # add external gateway IP address
-        addAnnotationToNode(v1, hostname, EXTERNAL_GW_IP, ex_gw_ip)
 
-        # add external interface name
-        addAnnotationToNode(v1, hostname, EXTERNAL_INTF_NAME, ex_gw_intf)
+    if hostname is None:
+        return
+
+    ipr = None
+    node = None
+
+    while True:
+        try:
+            if args.sync and ipr is None:
+                # subscribe before syncing so that no address change is missed
+                ipr = pyroute2.IPRoute()
+                ipr.bind(groups=RTMGRP_IPV4_IFADDR)
+
+            if node is None:
+                node = v1.read_node(name=hostname)
+            annotations = get_annotations(node, args.dpid, args.pod_cidr)
+            node = sync_annotations(v1, node, annotations)
+
+            if not args.sync:
+                return
+
+            # re-read the node on timeout, e.g. to catch up the pod CIDR
+            # which is assigned after the agent starts
+            timeout = SYNC_REFRESH_INTERVAL
+            if args.pod_cidr and not node.spec.pod_cidr:
+                timeout = SYNC_RETRY_INTERVAL
 
-        # add external bridge IP
-        addAnnotationToNode(v1, hostname, EXTERNAL_BR_IP, ex_br_ip)
+            interfaces = [get_external_interface(), EXT_BRIDGE]
+            if not watch_address_events(ipr, interfaces, timeout):
+                node = None
+        except Exception as e:
+            if not args.sync:
+                raise
+            # API server or OVS may be restarting, and address events may
+            # have been lost (e.g., ENOBUFS), so re-subscribe and re-read
+            print("failure sync annotations " + str(e))
+            if ipr is not None:
+                try:
+                    ipr.close()
+                except Exception:
+                    pass
+                ipr = None
+            node = None
+            time.sleep(SYNC_RETRY_INTERVAL)
 
 class SonaException(Exception):
 